@@ -1,72 +1,204 @@
 import streamlit as st
 import pandas as pd
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.ensemble import RandomForestClassifier
+import pyarrow.parquet as pq
 import os
 import random
+import itertools
+import collections
 import joblib
-import gspread
-from google.oauth2.service_account import Credentials
-import time
+import logging
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(page_title="Poké-Profiler & Dex", page_icon="🔮", layout="centered")
 
 # --- MODEL AND DATA FILENAMES ---
 MODEL_PATH = "trained_pokemon_model.joblib"
-DATA_PATH = "pokemon_data.csv"
+# Columnar copy of pokemon_data.csv. Regenerate it after editing the CSV with:
+# pyarrow.parquet.write_table(pyarrow.csv.read_csv("pokemon_data.csv"), "pokemon_data.parquet", compression="snappy")
+DATA_PATH = "pokemon_data.parquet"
+# Only the columns the app reads; the quiz-answer columns are training-only
+DATA_COLUMNS = ['pokemon_name', 'img_url', 'shiny_img_url', 'type1', 'pokedex_entry', 'hp', 'attack', 'defense', 'is_legendary', 'is_mythical']
+# Read only when the data file has them; the current file has no secondary types
+OPTIONAL_DATA_COLUMNS = ['type2']
+
+# --- QUIZ OPTIONS ---
+ENVIRONMENT_OPTIONS = ('Forests & Jungles', 'Oceans & Lakes', 'Mountains & Caves', 'Cities & Plains', 'Mysterious Places')
+BATTLE_STYLE_OPTIONS = ('Physical & Head-on', 'Strategic & Long-Range', 'Quick & Agile', 'Balanced & Versatile')
+CORE_STRENGTH_OPTIONS = ('Raw Power', 'Resilience', 'Speed & Evasion', 'Versatility')
+PERSONALITY_OPTIONS = ('Bold & Competitive', 'Calm & Loyal', 'Mysterious & Cunning', 'Energetic & Free-Spirited', 'Adaptable & Friendly')
+FEATURE_COLUMNS = ['environment', 'battle_style', 'core_strength', 'personality']
+# Feedback values as logged to the sheet, mapped to their on-screen labels
+FEEDBACK_OPTIONS = {
+    "Perfect Match": "✅ It's a perfect match!",
+    "Pretty Close": "🤔 It's pretty close",
+    "Not Right": "❌ Not quite right",
+}
 
 # --- GOOGLE SHEETS CONNECTION ---
+# --- IMPORTANT ---
+# PASTE THE FULL URL OF YOUR GOOGLE SHEET HERE.
+# This is the robust way to connect and prevents ambiguity.
+SHEET_URL = "https://docs.google.com/spreadsheets/d/11GZ8r4f9U8kTUlNT1eYk66sXe6XPlq-XxkPEdlqFxzo/edit?usp=sharing"
+# Buffered feedback is written once this many rows are pending, or this many seconds after the first one
+FEEDBACK_FLUSH_ROWS = 10
+FEEDBACK_FLUSH_SECONDS = 5.0
+# Failed writes are retried with doubling delays up to this limit
+FEEDBACK_MAX_RETRY_SECONDS = 300.0
+# Oldest rows are dropped beyond this many, so a sheet that keeps failing can't grow the buffer forever
+FEEDBACK_MAX_PENDING_ROWS = 1000
+
 @st.cache_resource
 def connect_to_gsheets():
+    # Imported here so sessions that never send feedback don't pay for loading the Google client libraries
+    import gspread
+    from google.oauth2.service_account import Credentials
+
     try:
         scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
         creds = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scopes)
         client = gspread.authorize(creds)
         return client
     except Exception as e:
-        st.error(f"Failed to connect to Google Sheets. Check secrets. Details: {e}")
-        st.stop()
+        # Raised rather than shown: this runs from the feedback callback, which reports it next to the form
+        raise RuntimeError(f"Could not connect to Google Sheets. Check secrets. ({e})") from e
 
-def log_feedback_to_sheet(feedback_data):
-    # --- IMPORTANT ---
-    # PASTE THE FULL URL OF YOUR GOOGLE SHEET HERE.
-    # This is the robust way to connect and prevents ambiguity.
-    SHEET_URL = "https://docs.google.com/spreadsheets/d/11GZ8r4f9U8kTUlNT1eYk66sXe6XPlq-XxkPEdlqFxzo/edit?usp=sharing"
+@st.cache_resource
+def get_feedback_worksheet():
+    # Open the sheet by its specific URL once per process, not on every feedback event
+    return connect_to_gsheets().open_by_url(SHEET_URL).sheet1
 
-    try:
-        client = connect_to_gsheets()
-        
-        # Open the sheet by its specific URL
-        spreadsheet = client.open_by_url(SHEET_URL)
-        sheet = spreadsheet.sheet1
-        
-        # Convert all values to simple strings before sending to prevent format errors
-        values_to_append = [str(v) for v in feedback_data.values()]
-        
-        # Append the new row
-        sheet.append_row(values_to_append)
-        
-        return True
-        
-    except Exception as e:
-        # Provide a helpful error message to the user if something goes wrong
-        st.error(f"Failed to write to Google Sheet. Please try again later. Details: {e}")
-        return False
+@st.cache_resource
+def get_feedback_executor():
+    return ThreadPoolExecutor(max_workers=2)
 
-def process_feedback(feedback_text):
+class FeedbackBuffer:
+    """
+    Collects feedback rows and writes them to the sheet in batches.
+    One instance is shared by every session via st.cache_resource, so all access goes through a lock.
+    """
+    def __init__(self, sheet, executor):
+        self.sheet = sheet
+        self.executor = executor
+        self._rows = []
+        self._lock = threading.Lock()
+        self._retry_delay = FEEDBACK_FLUSH_SECONDS
+        # All guarded by _lock: at most one flush is scheduled and one size-triggered flush
+        # is in flight at a time, and while a retry chain runs it alone decides when to write
+        self._flush_timer = None
+        self._flush_in_flight = False
+        self._retrying = False
+
+    def add(self, row):
+        with self._lock:
+            self._rows.append(row)
+            self._trim()
+            flush_now = (not self._retrying and not self._flush_in_flight
+                         and len(self._rows) >= FEEDBACK_FLUSH_ROWS)
+            if flush_now:
+                self._flush_in_flight = True
+            elif not self._retrying:
+                # Make sure the batch goes out even if it never fills up
+                self._schedule_flush(FEEDBACK_FLUSH_SECONDS)
+        if flush_now:
+            self.executor.submit(self.flush)
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                # An earlier flush already took these rows
+                self._flush_in_flight = False
+                return
+        try:
+            # One append_rows call is a single Sheets API request for the whole batch
+            self.sheet.append_rows(rows, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+        except Exception:
+            retry_in = None
+            with self._lock:
+                self._rows[:0] = rows
+                self._trim()
+                self._flush_in_flight = False
+                self._retrying = True
+                # A failure that overlaps an already scheduled flush joins it instead of starting its own chain
+                if self._flush_timer is None:
+                    retry_in = self._retry_delay
+                    self._retry_delay = min(retry_in * 2, FEEDBACK_MAX_RETRY_SECONDS)
+                    self._schedule_flush(retry_in)
+            if retry_in is None:
+                logger.exception("Failed to write %d feedback rows to Google Sheet; a retry is already scheduled.", len(rows))
+            else:
+                logger.exception("Failed to write %d feedback rows to Google Sheet; retrying in %.0fs.", len(rows), retry_in)
+        else:
+            with self._lock:
+                self._flush_in_flight = False
+                self._retrying = False
+                self._retry_delay = FEEDBACK_FLUSH_SECONDS
+                # Rows that arrived while this write was in flight still need a flush
+                if self._rows:
+                    self._schedule_flush(FEEDBACK_FLUSH_SECONDS)
+
+    def _schedule_flush(self, delay):
+        # Caller holds the lock; does nothing if a flush is already scheduled
+        if self._flush_timer is not None:
+            return
+        self._flush_timer = threading.Timer(delay, self._run_scheduled_flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def _run_scheduled_flush(self):
+        with self._lock:
+            self._flush_timer = None
+        self.executor.submit(self.flush)
+
+    def _trim(self):
+        # Caller holds the lock
+        overflow = len(self._rows) - FEEDBACK_MAX_PENDING_ROWS
+        if overflow > 0:
+            del self._rows[:overflow]
+            logger.warning("Feedback buffer full; dropped the %d oldest rows.", overflow)
+
+@st.cache_resource
+def get_feedback_buffer():
+    feedback_buffer = FeedbackBuffer(get_feedback_worksheet(), get_feedback_executor())
+    # Write out anything still buffered when the server shuts down
+    atexit.register(feedback_buffer.flush)
+    return feedback_buffer
+
+def process_feedback():
     """
     Callback function to log feedback and update session state.
-    This function is executed when a feedback button is clicked, before the script reruns.
+    This function is executed when the feedback form is submitted, before the fragment reruns.
+    It only sets session state: elements written from a fragment callback would land at the top
+    of the app, so problems are stored in `feedback_error` and shown by display_prediction().
+    The row is buffered and written to the sheet in the background, so the thank-you screen isn't held up.
     """
-    profile_data_to_log = st.session_state.last_input[0].copy()
-    profile_data_to_log['pokemon_name'] = st.session_state.prediction_details['name']
-    profile_data_to_log['feedback'] = feedback_text
+    feedback_choice = st.session_state.feedback_choice
+    if feedback_choice is None:
+        st.session_state.feedback_error = "Pick how well this partner matches you before submitting."
+        return
 
-    if log_feedback_to_sheet(profile_data_to_log):
-        st.session_state.show_thank_you = True
-        del st.session_state.prediction_details
+    last_input = st.session_state.last_input
+    # Fixed sheet schema: environment, battle_style, core_strength, personality, pokemon_name, feedback
+    row = [
+        last_input['environment'], last_input['battle_style'], last_input['core_strength'], last_input['personality'],
+        st.session_state.prediction_details['name'], feedback_choice,
+    ]
+
+    try:
+        feedback_buffer = get_feedback_buffer()
+    except Exception as e:
+        # Provide a helpful error message to the user if something goes wrong
+        st.session_state.feedback_error = f"Failed to write to Google Sheet. Please try again later. Details: {e}"
+        return
+
+    feedback_buffer.add(row)
+    st.session_state.show_thank_you = True
+    del st.session_state.prediction_details
 
 # --- DATA & MODEL LOADING ---
 @st.cache_resource
@@ -76,15 +208,80 @@ def load_model():
 
 @st.cache_data
 def load_pokemon_data():
-    if os.path.exists(DATA_PATH): return pd.read_csv(DATA_PATH)
-    else: st.error(f"Fatal Error: `{DATA_PATH}` not found."); st.stop()
+    if not os.path.exists(DATA_PATH): st.error(f"Fatal Error: `{DATA_PATH}` not found."); st.stop()
+    # Arrow-backed strings avoid object columns; the low-cardinality columns get compact dtypes
+    available_columns = set(pq.read_schema(DATA_PATH).names)
+    columns = DATA_COLUMNS + [c for c in OPTIONAL_DATA_COLUMNS if c in available_columns]
+    df = pd.read_parquet(DATA_PATH, engine="pyarrow", columns=columns, dtype_backend="pyarrow")
+    df['type1'] = df['type1'].astype('category')
+    df['is_legendary'] = df['is_legendary'].astype(bool)
+    df['is_mythical'] = df['is_mythical'].astype(bool)
+    return df
+
+@st.cache_resource
+def build_prediction_table(_pipeline):
+    """
+    Predicts every possible quiz answer combination in one batch.
+    The quiz only has a few hundred combinations, so a submit becomes a dict lookup.
+    """
+    combinations = list(itertools.product(ENVIRONMENT_OPTIONS, BATTLE_STYLE_OPTIONS, CORE_STRENGTH_OPTIONS, PERSONALITY_OPTIONS))
+    predictions = _pipeline.predict(pd.DataFrame(combinations, columns=FEATURE_COLUMNS))
+    # tolist() gives plain str names, which gspread and session state handle natively
+    return dict(zip(combinations, predictions.tolist()))
+
+# Display fields for one Pokémon; type names are stored capitalized
+PokeRow = collections.namedtuple('PokeRow', 'img_url shiny_img_url type1 type2 hp attack defense pokedex_entry')
+
+@st.cache_resource
+def build_pokemon_info(_df):
+    """Maps each Pokémon name to a PokeRow holding only the fields shown on the prediction screen."""
+    # Built column by column so pandas does the per-row work, instead of a nested to_dict('index')
+    if 'type2' in _df:
+        type2 = [t.capitalize() if pd.notna(t) else None for t in _df['type2'].tolist()]
+    else:
+        type2 = [None] * len(_df)
+    rows = zip(
+        _df['img_url'].tolist(),
+        _df['shiny_img_url'].tolist(),
+        _df['type1'].str.capitalize().tolist(),
+        type2,
+        _df['hp'].tolist(),
+        _df['attack'].tolist(),
+        _df['defense'].tolist(),
+        _df['pokedex_entry'].tolist(),
+    )
+    return dict(zip(_df['pokemon_name'].tolist(), map(PokeRow._make, rows)))
+
+@st.cache_resource
+def legendary_names(_df):
+    # A tuple, since the cached pool is shared by every session and must not be mutated
+    return tuple(_df.loc[_df['is_legendary'] | _df['is_mythical'], 'pokemon_name'].tolist())
+
+@st.cache_resource
+def get_rng():
+    # One generator per process, so reruns don't reseed it and draws stay off the module-level global
+    return random.Random()
 
 # --- INITIALIZATION ---
 pipeline = load_model()
+PREDICTION_TABLE = build_prediction_table(pipeline)
 pokemon_data_df = load_pokemon_data()
-POKEMON_INFO = pokemon_data_df.set_index('pokemon_name').to_dict('index')
+POKEMON_INFO = build_pokemon_info(pokemon_data_df)
+LEGENDARY_NAMES = legendary_names(pokemon_data_df)
+_RNG = get_rng()
 
 # --- UI COMPONENTS ---
+def display_base_stats(hp, attack, defense):
+    """Renders the base stats as a single HTML grid instead of a row of metric widgets."""
+    stats = "".join(
+        f"<div><div style='font-size:0.875rem'>{label}</div><div style='font-size:2.25rem'>{value}</div></div>"
+        for label, value in (("HP", hp), ("Attack", attack), ("Defense", defense))
+    )
+    st.markdown(
+        f"**Base Stats:**\n\n<div style='display:grid;grid-template-columns:1fr 1fr 1fr'>{stats}</div>",
+        unsafe_allow_html=True,
+    )
+
 def display_prediction():
     """
     Displays the prediction results and handles feedback using on_click callbacks.
@@ -98,8 +295,8 @@ def display_prediction():
     if is_shiny: st.success("Whoa! A rare Shiny partner appeared!", icon="✨"); st.balloons()
     
     st.subheader("Your Pokémon Partner is...")
-    pokemon_info = POKEMON_INFO.get(prediction)
-    img_to_display = pokemon_info['shiny_img_url'] if is_shiny else pokemon_info['img_url']
+    pokemon_info = POKEMON_INFO[prediction]
+    img_to_display = pokemon_info.shiny_img_url if is_shiny else pokemon_info.img_url
     
     col1, col2 = st.columns([1, 2])
     with col1: st.image(img_to_display, width=200)
@@ -107,82 +304,79 @@ def display_prediction():
         title = f"{prediction} ✨" if is_shiny else prediction
         st.markdown(f"## {title}")
         
-        # --- FIX APPLIED HERE ---
-        # Use .get() to safely access 'type2' which may not exist
-        type2_val = pokemon_info.get('type2')
-        type2_info = f" / `{type2_val.capitalize()}`" if pd.notna(type2_val) else ""
-        st.markdown(f"**Type:** `{pokemon_info['type1'].capitalize()}`{type2_info}")
-
-        st.write("**Base Stats:**")
-        stat_cols = st.columns(3)
-        stat_cols[0].metric("HP", pokemon_info['hp'])
-        stat_cols[1].metric("Attack", pokemon_info['attack'])
-        stat_cols[2].metric("Defense", pokemon_info['defense'])
-    st.info(f"**Pokédex Entry:** *{pokemon_info['pokedex_entry']}*")
+        type2_info = f" / `{pokemon_info.type2}`" if pokemon_info.type2 else ""
+        st.markdown(f"**Type:** `{pokemon_info.type1}`{type2_info}")
+
+        display_base_stats(pokemon_info.hp, pokemon_info.attack, pokemon_info.defense)
+    st.info(f"**Pokédex Entry:** *{pokemon_info.pokedex_entry}*")
     
     st.write("---")
     st.write("**Is this your perfect partner?** Your feedback helps the Profiler get smarter!")
         
-    feedback_cols = st.columns(3)
-    
-    feedback_cols[0].button(
-        "✅ It's a perfect match!",
-        on_click=process_feedback,
-        args=("Perfect Match",),
-        use_container_width=True
-    )
-    feedback_cols[1].button(
-        "🤔 It's pretty close",
-        on_click=process_feedback,
-        args=("Pretty Close",),
-        use_container_width=True
-    )
-    feedback_cols[2].button(
-        "❌ Not quite right",
-        on_click=process_feedback,
-        args=("Not Right",),
-        use_container_width=True
-    )
+    # A form, so picking an option doesn't rerun anything until the feedback is submitted
+    with st.form("feedback_form"):
+        st.radio(
+            "Rate this match",
+            FEEDBACK_OPTIONS,
+            format_func=FEEDBACK_OPTIONS.get,
+            index=None,
+            key="feedback_choice",
+            horizontal=True,
+            label_visibility="collapsed",
+        )
+        st.form_submit_button("Submit Feedback", on_click=process_feedback, use_container_width=True)
+    feedback_error = st.session_state.pop('feedback_error', None)
+    if feedback_error: st.error(feedback_error)
 
 def display_thank_you():
     """Displays a confirmation screen after feedback is submitted."""
     st.success("Thank you! Your feedback has been recorded and the Profiler is now learning from your insights.", icon="✨")
-    st.balloons()
     if st.button("Take the Quiz Again!", use_container_width=True):
         del st.session_state.show_thank_you
         st.rerun()
 
+@st.fragment
+def prediction_fragment():
+    """
+    Shows the prediction and, once feedback is given, the thank-you screen.
+    As a fragment, feedback clicks only rerun this block instead of the whole script.
+    """
+    if 'prediction_details' in st.session_state:
+        display_prediction()
+    else:
+        display_thank_you()
+
 def display_quiz():
     """Displays the main quiz form."""
     with st.form("profiler_form"):
         st.subheader("Discover Your Partner")
         st.write("Answer these questions to find your Pokémon companion.")
-        environment = st.selectbox("Which environment do you feel most at home in?", ('Forests & Jungles', 'Oceans & Lakes', 'Mountains & Caves', 'Cities & Plains', 'Mysterious Places'))
-        personality = st.radio("Which best describes your personality?", ['Bold & Competitive', 'Calm & Loyal', 'Mysterious & Cunning', 'Energetic & Free-Spirited', 'Adaptable & Friendly'])
-        core_strength = st.selectbox("What do you value most in a partner?", ('Raw Power', 'Resilience', 'Speed & Evasion', 'Versatility'))
-        battle_style = st.radio("How do you approach challenges?", ['Physical & Head-on', 'Strategic & Long-Range', 'Quick & Agile', 'Balanced & Versatile'])
+        environment = st.selectbox("Which environment do you feel most at home in?", ENVIRONMENT_OPTIONS)
+        personality = st.radio("Which best describes your personality?", PERSONALITY_OPTIONS)
+        core_strength = st.selectbox("What do you value most in a partner?", CORE_STRENGTH_OPTIONS)
+        battle_style = st.radio("How do you approach challenges?", BATTLE_STYLE_OPTIONS)
         destiny_checked = st.checkbox("Do you feel a touch of destiny?", help="Checking this may lead to a legendary encounter...")
         submitted = st.form_submit_button("Discover My Partner!")
 
     if submitted:
-        input_data = pd.DataFrame([[environment, battle_style, core_strength, personality]],
-                                  columns=['environment', 'battle_style', 'core_strength', 'personality'])
-        
-        prediction = pipeline.predict(input_data)[0]
-        is_legendary_encounter = False
-        if destiny_checked and personality == 'Mysterious & Cunning' and core_strength == 'Raw Power':
-            if random.randint(1, 20) == 1:
-                legendary_pool = pokemon_data_df[pokemon_data_df['is_legendary'] | pokemon_data_df['is_mythical']]
-                if not legendary_pool.empty:
-                    prediction = legendary_pool.sample(n=1)['pokemon_name'].iloc[0]
-                    is_legendary_encounter = True
+        prediction = PREDICTION_TABLE[(environment, battle_style, core_strength, personality)]
+        # The legendary roll only happens once the cheap answer checks pass
+        is_legendary_encounter = (destiny_checked and personality == 'Mysterious & Cunning' and core_strength == 'Raw Power'
+                                  and bool(LEGENDARY_NAMES) and _RNG.random() < 0.05)
+        if is_legendary_encounter:
+            prediction = _RNG.choice(LEGENDARY_NAMES)
 
         st.session_state.prediction_details = {
             "name": prediction,
             "is_legendary": is_legendary_encounter,
-            "is_shiny": (random.randint(1, 100) == 1),
+            "is_shiny": _RNG.random() < 0.01,
+        }
+        st.session_state.last_input = {
+            'environment': environment,
+            'battle_style': battle_style,
+            'core_strength': core_strength,
+            'personality': personality,
         }
-        st.session_state.last_input = input_data.to_dict('records')
         st.rerun()
 
 def display_search_results(search_query):
@@ -194,7 +388,7 @@ def display_search_results(search_query):
         for _, pokemon_info in results.iterrows():
             st.write("---")
             # For fun, let's keep the shiny chance on search
-            is_shiny = (random.randint(1, 4096) == 1)
+            is_shiny = _RNG.random() < 1 / 4096
             img_to_display = pokemon_info['shiny_img_url'] if is_shiny else pokemon_info['img_url']
             
             col1, col2 = st.columns([1, 2])
@@ -210,11 +404,7 @@ def display_search_results(search_query):
                 type2_info = f" / `{type2_val.capitalize()}`" if pd.notna(type2_val) else ""
                 st.markdown(f"**Type:** `{pokemon_info['type1'].capitalize()}`{type2_info}")
                 
-                st.write("**Base Stats:**")
-                stat_cols = st.columns(3)
-                stat_cols[0].metric("HP", pokemon_info['hp'])
-                stat_cols[1].metric("Attack", pokemon_info['attack'])
-                stat_cols[2].metric("Defense", pokemon_info['defense'])
+                display_base_stats(pokemon_info['hp'], pokemon_info['attack'], pokemon_info['defense'])
 
             st.info(f"**Pokédex Entry:** *{pokemon_info['pokedex_entry']}*")
     else:
@@ -234,9 +424,7 @@ if search_term:
 else:
     # Quiz and Prediction Logic
     st.write("---")
-    if 'prediction_details' in st.session_state:
-        display_prediction()
-    elif 'show_thank_you' in st.session_state:
-        display_thank_you()
+    if 'prediction_details' in st.session_state or 'show_thank_you' in st.session_state:
+        prediction_fragment()
     else:
         display_quiz()